@@ -16,6 +16,9 @@ app.use(express.json());
 
 const pubsub = new PubSub();
 const PORT = process.env.PORT || 8080;
+const DSP_ENGINE_URL = process.env.DSP_ENGINE_URL || '';
+const PROXY_SUFFIX = '.proxy.wav';
+const PROXY_TIMEOUT_MS = Number(process.env.PROXY_TIMEOUT_MS) || 60000;
 
 // Initialize Supabase
 const supabase = createClient(
@@ -45,6 +48,11 @@ app.post('/trigger', async (req: any, res: any) => {
         return res.status(400).send('Incomplete GCS event data');
     }
 
+    // The DSP engine writes analysis proxies into the same bucket; don't analyze them again
+    if (name.endsWith(PROXY_SUFFIX)) {
+        return res.status(200).send('Skipped analysis proxy');
+    }
+
     // Try to find jobId in metadata (passed from frontend)
     const jobId = eventData.metadata?.jobId || name.split('/').pop()?.split('_')[0];
 
@@ -55,7 +63,26 @@ app.post('/trigger', async (req: any, res: any) => {
             await supabase.from('mastering_jobs').update({ status: 'analyzing' }).eq('id', jobId);
         }
 
-        const audioFileData = { fileData: { fileUri: `gs://${bucket}/${name}`, mimeType: 'audio/wav' } };
+        // Ask the DSP engine for a small mono 16 kHz excerpt; fall back to the original on failure
+        let analysisUri = `gs://${bucket}/${name}`;
+        if (DSP_ENGINE_URL) {
+            try {
+                const proxyRes = await fetch(`${DSP_ENGINE_URL}/proxy`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ jobId, bucket, path: name }),
+                    signal: AbortSignal.timeout(PROXY_TIMEOUT_MS)
+                });
+                if (!proxyRes.ok) throw new Error(`HTTP ${proxyRes.status}`);
+                const proxy: any = await proxyRes.json();
+                analysisUri = proxy.proxyUri;
+                console.log(`Using analysis proxy ${analysisUri} (${proxy.sizeRatio}x smaller)`);
+            } catch (proxyErr: any) {
+                console.warn('Analysis proxy failed, using original upload:', proxyErr.message);
+            }
+        }
+
+        const audioFileData = { fileData: { fileUri: analysisUri, mimeType: 'audio/wav' } };
 
         // 1. Audience Persona Call
         console.log('Consulting Audience Agent...');
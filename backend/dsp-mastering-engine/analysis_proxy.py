@@ -0,0 +1,145 @@
+"""
+Analysis Proxy — AI 解析用の軽量プロキシ生成
+ペルソナ解析は「ざっと聴く」だけなのでフル解像度 WAV は不要。
+モノラル（または M/S）・ポリフェーズでダウンサンプル・高エネルギー区間のみ・16bit PCM に縮める。
+入力は 1 パスのチャンク処理で読み、フル解像度の float 配列は作らない。
+"""
+
+import math
+import os
+from typing import List
+
+import numpy as np
+import scipy.io.wavfile as wavfile
+from scipy import signal
+
+PROXY_SAMPLE_RATE = 16000
+PROXY_SECTION_SECONDS = 10.0   # 区間の長さ（エネルギー判定の窓）
+PROXY_MAX_SECONDS = 60.0       # プロキシ全体の最大長
+PROXY_FADE_MS = 10.0           # 区間のつなぎ目のクリック防止
+CHUNK_FRAMES = 1 << 18
+PROXY_SUFFIX = ".proxy.wav"
+
+
+def proxy_path_for(path: str) -> str:
+    """原音と同じ場所に置くプロキシのパス（例: uploads/a_b.wav → uploads/a_b.proxy.wav）"""
+    base, _ = os.path.splitext(path)
+    return base + PROXY_SUFFIX
+
+
+def _read_wav_lazy(path: str):
+    # 24bit 等 mmap 非対応フォーマットは通常読み込みにフォールバック
+    try:
+        return wavfile.read(path, mmap=True)
+    except ValueError:
+        return wavfile.read(path)
+
+
+def _to_float(chunk: np.ndarray) -> np.ndarray:
+    if chunk.dtype == np.int16:
+        return chunk.astype(np.float32) * (1.0 / 32768.0)
+    if chunk.dtype == np.int32:
+        return chunk.astype(np.float32) * (1.0 / 2147483648.0)
+    if chunk.dtype == np.uint8:
+        return (chunk.astype(np.float32) - 128.0) * (1.0 / 128.0)
+    return chunk.astype(np.float32)
+
+
+def _downmix(chunk: np.ndarray, mid_side: bool) -> np.ndarray:
+    """(frames,) / (frames, ch) → (n_out_channels, frames)。M/S 時は行 0 = Mid、行 1 = Side。"""
+    x = _to_float(chunk)
+    if x.ndim == 1:
+        left = right = x
+    else:
+        left = x[:, 0]
+        right = x[:, 1] if x.shape[1] > 1 else x[:, 0]
+    mid = (left + right) * 0.5
+    if not mid_side:
+        return mid[np.newaxis, :]
+    return np.stack([mid, (left - right) * 0.5])
+
+
+def _stream_resample(data: np.ndarray, up: int, down: int, mid_side: bool) -> np.ndarray:
+    """
+    resample_poly をチャンク単位で適用する。各チャンクの前後にフィルタ長ぶんの文脈を付けて
+    境界を切り落とすので、全体を一括で resample_poly したのと同じ結果になる。
+    """
+    frames = data.shape[0]
+    n_out = -(-frames * up // down)
+    channels = 2 if mid_side else 1
+    out = np.zeros((channels, n_out), dtype=np.float32)
+
+    # resample_poly の既定フィルタ半長（入力サンプル換算）を down の倍数に切り上げた文脈長
+    half_len_in = 10 * max(up, down) // up + 1
+    pad = down * max(1, math.ceil(half_len_in / down))
+    step = max(down, (CHUNK_FRAMES // down) * down)
+
+    for start in range(0, frames, step):
+        stop = min(frames, start + step)
+        lo = max(0, start - pad)
+        hi = min(frames, stop + pad)
+        block = signal.resample_poly(_downmix(data[lo:hi], mid_side), up, down, axis=1)
+        skip = (start - lo) * up // down
+        o0 = start * up // down
+        o1 = min(n_out, -(-stop * up // down))
+        out[:, o0:o1] = block[:, skip:skip + (o1 - o0)]
+    return out
+
+
+def _select_sections(proxy: np.ndarray, sample_rate: int) -> np.ndarray:
+    """RMS の大きい区間を PROXY_MAX_SECONDS ぶん選び、時間順に短いフェードでつなぐ。"""
+    section = int(PROXY_SECTION_SECONDS * sample_rate)
+    n_sections = proxy.shape[1] // section
+    max_sections = max(1, int(PROXY_MAX_SECONDS // PROXY_SECTION_SECONDS))
+    if n_sections <= max_sections:
+        return proxy
+
+    windows = proxy[0, :n_sections * section].reshape(n_sections, section)
+    energy = np.einsum('ij,ij->i', windows, windows)
+    chosen = np.sort(np.argsort(energy)[-max_sections:])
+
+    fade = max(1, int(PROXY_FADE_MS / 1000 * sample_rate))
+    ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)
+    parts: List[np.ndarray] = []
+    for idx in chosen:
+        part = proxy[:, idx * section:(idx + 1) * section].copy()
+        part[:, :fade] *= ramp
+        part[:, -fade:] *= ramp[::-1]
+        parts.append(part)
+    return np.concatenate(parts, axis=1)
+
+
+def make_analysis_proxy(
+    input_path: str,
+    output_path: str,
+    target_rate: int = PROXY_SAMPLE_RATE,
+    mid_side: bool = False,
+) -> dict:
+    """
+    input_path の WAV から解析用プロキシ WAV を output_path に書き出す。
+    戻り値: サイズや長さなどのメタ情報（ログ・DB 用）
+    """
+    sample_rate, data = _read_wav_lazy(input_path)
+    frames = data.shape[0]
+
+    rate = min(target_rate, sample_rate)
+    g = math.gcd(rate, sample_rate)
+    up, down = rate // g, sample_rate // g
+
+    if up == down:
+        proxy = _downmix(data, mid_side)
+    else:
+        proxy = _stream_resample(data, up, down, mid_side)
+    del data
+
+    proxy = _select_sections(proxy, rate)
+
+    pcm16 = np.clip(proxy * 32767.0, -32768, 32767).astype(np.int16)
+    wavfile.write(output_path, rate, np.ascontiguousarray(pcm16.T) if mid_side else pcm16[0])
+
+    return {
+        "sampleRate": rate,
+        "channels": "ms" if mid_side else "mono",
+        "sourceSeconds": round(frames / sample_rate, 2),
+        "proxySeconds": round(proxy.shape[1] / rate, 2),
+    }
@@ -1,14 +1,18 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from google.cloud import storage
 import numpy as np
 import scipy.io.wavfile as wavfile
 import os
+import tempfile
 import time
 import json
 import traceback
-from typing import Optional
+from typing import Optional, Tuple
 import audio_logic as dsp
+import analysis_proxy
+from dsp_worker_pool import DSPWorkerPool, SharedPCM, load_pcm
 import requests
 
 from supabase import create_client, Client
@@ -31,6 +35,50 @@ class MasteringRequest(BaseModel):
 
 storage_client = storage.Client()
 
+# DSP は事前起動したワーカープロセスで実行（PCM は共有メモリ経由で受け渡す）
+dsp_pool = DSPWorkerPool()
+
+@app.on_event("startup")
+def start_dsp_pool():
+    dsp_pool.start()
+
+@app.on_event("shutdown")
+def stop_dsp_pool():
+    dsp_pool.shutdown()
+
+# ─── Blocking I/O helpers (async handlers run these via run_in_threadpool) ──
+
+def read_wav_pcm(path: str) -> Tuple[int, SharedPCM]:
+    """Read a WAV straight into shared memory (float32 range [-1, 1], stereo)."""
+    sample_rate, data = wavfile.read(path)
+    return sample_rate, load_pcm(data)
+
+
+def write_wav_pcm(path: str, sample_rate: int, pcm: SharedPCM) -> None:
+    """Write the stereo PCM as float32 WAV for high fidelity."""
+    wavfile.write(path, sample_rate, np.stack([pcm.left, pcm.right], axis=1))
+
+
+def download_url(url: str, path: str) -> int:
+    with requests.get(url, timeout=300, stream=True) as res:
+        res.raise_for_status()
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in res.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                size += len(chunk)
+    return size
+
+
+def upload_to_mastered(storage_path: str, local_path: str) -> None:
+    with open(local_path, "rb") as f:
+        supabase.storage.from_("mastered").upload(
+            storage_path,
+            f.read(),
+            {"content-type": "audio/wav", "x-upsert": "true"}
+        )
+
+
 @app.get("/")
 async def health_check():
     return {"status": "ok", "engine": "Neuro-Master-Python"}
@@ -77,7 +125,9 @@ async def process_audio_internal(request: MasteringRequest):
         job_info = {}
         if request.jobId and supabase:
             try:
-                res = supabase.table("mastering_jobs").select("user_email, file_name").eq("id", request.jobId).execute()
+                res = await run_in_threadpool(
+                    supabase.table("mastering_jobs").select("user_email, file_name").eq("id", request.jobId).execute
+                )
                 if res.data:
                     job_info = res.data[0]
             except Exception as e:
@@ -87,68 +137,50 @@ async def process_audio_internal(request: MasteringRequest):
         local_input = f"/tmp/input_{int(time.time())}.wav"
         bucket = storage_client.bucket(request.inputBucket)
         blob = bucket.blob(request.inputPath)
-        blob.download_to_filename(local_input)
-        
-        # 2. Read WAV
-        sample_rate, data = wavfile.read(local_input)
-        
-        # Convert to float32 range [-1, 1] if needed
-        if data.dtype == np.int16:
-            data = data.astype(np.float32) / 32768.0
-        elif data.dtype == np.int32:
-            data = data.astype(np.float32) / 2147483648.0
-            
-        # Ensure stereo
-        if len(data.shape) == 1:
-            left = data.copy()
-            right = data.copy()
-        else:
-            left = data[:, 0].copy()
-            right = data[:, 1].copy()
+        await run_in_threadpool(blob.download_to_filename, local_input)
 
-        # 3. Parameter setup & Optimization
-        params = dsp.MasteringParams(**(request.params or {}))
-        
-        if request.targetLUFS:
-            print(f"Optimizing for target LUFS: {request.targetLUFS}")
-            optimized_params, achieved_lufs, iterations = dsp.optimize_mastering_params(
-                left, right, sample_rate, request.targetLUFS, params
+        # 2. Read WAV straight into shared memory (float32 range [-1, 1], stereo)
+        sample_rate, pcm = await run_in_threadpool(read_wav_pcm, local_input)
+
+        try:
+            # 3. Parameter setup, Optimization & Mastering Chain (in a DSP worker)
+            params = dsp.MasteringParams(**(request.params or {}))
+
+            if request.targetLUFS:
+                print(f"Optimizing for target LUFS: {request.targetLUFS}")
+            print("Applying mastering chain...")
+            params, achieved_lufs, iterations, _, _ = await dsp_pool.master(
+                pcm, sample_rate, params, request.targetLUFS or None
             )
-            params = optimized_params
-            print(f"Optimization finished: {achieved_lufs} LUFS in {iterations} iterations")
+            if request.targetLUFS:
+                print(f"Optimization finished: {achieved_lufs} LUFS in {iterations} iterations")
+
+            # 5. Save & Upload
+            local_output = f"/tmp/output_{int(time.time())}.wav"
+            await run_in_threadpool(write_wav_pcm, local_output, sample_rate, pcm)
+        finally:
+            pcm.close()
 
-        # 4. Apply Mastering Chain
-        print("Applying mastering chain...")
-        dsp.build_mastering_chain(left, right, sample_rate, params)
-        
-        # 5. Save & Upload
-        local_output = f"/tmp/output_{int(time.time())}.wav"
-        # Stack back to stereo
-        mastered_data = np.stack([left, right], axis=1)
-        # Convert back to int16 for compatibility if needed, or keep float32
-        # Here we use float32 for high fidelity
-        wavfile.write(local_output, sample_rate, mastered_data)
-        
         out_bucket = storage_client.bucket(request.outputBucket)
         out_blob = out_bucket.blob(request.outputPath)
-        out_blob.upload_from_filename(local_output)
-        
+        await run_in_threadpool(out_blob.upload_from_filename, local_output)
+
         # Metadata update
         out_blob.metadata = {
             "masteredBy": "Neuro-Master-Python",
             "params": json.dumps(dsp.params_to_dict(params) if hasattr(dsp, 'params_to_dict') else str(params))
         }
-        out_blob.patch()
+        await run_in_threadpool(out_blob.patch)
 
         # Cleanup
         os.remove(local_input)
         os.remove(local_output)
         
         if request.jobId and supabase:
-            supabase.table("mastering_jobs").update({
+            await run_in_threadpool(supabase.table("mastering_jobs").update({
                 "status": "completed",
                 "output_path": f"gs://{request.outputBucket}/{request.outputPath}"
-            }).eq("id", request.jobId).execute()
+            }).eq("id", request.jobId).execute)
 
             # Trigger email notification via Vercel Function
             user_email = job_info.get("user_email")
@@ -157,7 +189,7 @@ async def process_audio_internal(request: MasteringRequest):
                     app_url = os.environ.get("NEXT_PUBLIC_APP_URL", "https://neuro-master-beatport-top-10-ai.vercel.app")
                     notify_url = f"{app_url}/api/notify"
                     print(f"Triggering notification for {user_email} at {notify_url}")
-                    requests.post(notify_url, json={
+                    await run_in_threadpool(requests.post, notify_url, json={
                         "email": user_email,
                         "jobId": request.jobId,
                         "fileName": job_info.get("file_name", "your mastered track")
@@ -176,10 +208,10 @@ async def process_audio_internal(request: MasteringRequest):
         print(f"Error: {error_msg}")
         if request.jobId and supabase:
             try:
-                supabase.table("mastering_jobs").update({
+                await run_in_threadpool(supabase.table("mastering_jobs").update({
                     "status": "failed",
                     "error_message": f"DSP Engine Error: {error_msg}"
-                }).eq("id", request.jobId).execute()
+                }).eq("id", request.jobId).execute)
             except Exception as db_err:
                 print(f"Failed to update error in Supabase: {str(db_err)}")
         raise HTTPException(status_code=500, detail=error_msg)
@@ -207,89 +239,64 @@ async def master_from_url(request: MasterFromUrlRequest):
 
         # 1. 署名付き URL から HTTP ダウンロード
         local_input = f"/tmp/input_{request.jobId}.wav"
-        dl_res = requests.get(request.downloadUrl, timeout=300)
-        dl_res.raise_for_status()
-        with open(local_input, "wb") as f:
-            f.write(dl_res.content)
-        print(f"[/master] Downloaded {len(dl_res.content)} bytes")
-
-        # 2. WAV 読み込み
-        sample_rate, data = wavfile.read(local_input)
-
-        if data.dtype == np.int16:
-            data = data.astype(np.float32) / 32768.0
-        elif data.dtype == np.int32:
-            data = data.astype(np.float32) / 2147483648.0
-        elif data.dtype == np.float32:
-            pass
-
-        if len(data.shape) == 1:
-            left = data.copy()
-            right = data.copy()
-        else:
-            left = data[:, 0].copy()
-            right = data[:, 1].copy()
+        downloaded = await run_in_threadpool(download_url, request.downloadUrl, local_input)
+        print(f"[/master] Downloaded {downloaded} bytes")
 
-        print(f"[/master] Audio: {sample_rate}Hz, {len(left)} frames, {len(left)/sample_rate:.1f}s")
+        # 2. WAV 読み込み（共有メモリへ直接デコード）
+        sample_rate, pcm = await run_in_threadpool(read_wav_pcm, local_input)
 
-        # 3. DSP パラメータ設定 + LUFS 最適化
-        params = dsp.MasteringParams(**(request.params or {}))
+        print(f"[/master] Audio: {sample_rate}Hz, {pcm.frames} frames, {pcm.frames/sample_rate:.1f}s")
 
-        target = request.targetLUFS or -14.0
-        print(f"[/master] Optimizing for {target} LUFS...")
-        optimized_params, achieved_lufs, iterations = dsp.optimize_mastering_params(
-            left, right, sample_rate, target, params
-        )
-        params = optimized_params
-        print(f"[/master] Optimization: {achieved_lufs:.1f} LUFS in {iterations} iterations")
+        try:
+            # 3-4. DSP パラメータ設定 + LUFS 最適化 + マスタリングチェーン適用（DSP ワーカーで実行）
+            params = dsp.MasteringParams(**(request.params or {}))
 
-        # 4. マスタリングチェーン適用
-        print("[/master] Applying mastering chain...")
-        dsp.build_mastering_chain(left, right, sample_rate, params)
+            target = request.targetLUFS or -14.0
+            print(f"[/master] Optimizing for {target} LUFS and applying mastering chain...")
+            params, achieved_lufs, iterations, final_lufs, cache_stats = await dsp_pool.master(
+                pcm, sample_rate, params, target, measure_output=True
+            )
+            print(f"[/master] Optimization: {achieved_lufs:.1f} LUFS in {iterations} iterations")
 
-        # 5. WAV 書き出し (float32 高品質)
-        local_output = f"/tmp/output_{request.jobId}.wav"
-        mastered_data = np.stack([left, right], axis=1)
-        wavfile.write(local_output, sample_rate, mastered_data)
+            # 5. WAV 書き出し (float32 高品質)
+            local_output = f"/tmp/output_{request.jobId}.wav"
+            await run_in_threadpool(write_wav_pcm, local_output, sample_rate, pcm)
+        finally:
+            pcm.close()
         output_size = os.path.getsize(local_output)
         print(f"[/master] Output: {output_size} bytes")
 
         # 6. Supabase Storage にアップロード
         output_storage_path = f"{request.jobId}/master_{request.fileName}"
-        with open(local_output, "rb") as f:
-            upload_res = supabase.storage.from_("mastered").upload(
-                output_storage_path,
-                f.read(),
-                {"content-type": "audio/wav", "x-upsert": "true"}
-            )
+        await run_in_threadpool(upload_to_mastered, output_storage_path, local_output)
         print(f"[/master] Uploaded to mastered/{output_storage_path}")
 
         # 7. 署名付きダウンロード URL 生成 (7日間有効)
-        signed = supabase.storage.from_("mastered").create_signed_url(
+        signed = await run_in_threadpool(
+            supabase.storage.from_("mastered").create_signed_url,
             output_storage_path, 60 * 60 * 24 * 7
         )
         output_url = signed.get("signedURL") or signed.get("signedUrl", "")
 
         # 8. DB 更新
-        final_lufs = dsp.measure_lufs(left, right, sample_rate)
-        supabase.table("mastering_jobs").update({
+        await run_in_threadpool(supabase.table("mastering_jobs").update({
             "status": "completed",
             "output_path": output_storage_path,
             "output_url": output_url,
             "lufs_achieved": round(final_lufs, 2),
             "final_params": dsp.params_to_dict(params),
             "completed_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-        }).eq("id", request.jobId).execute()
+        }).eq("id", request.jobId).execute)
 
         # 9. 通知トリガー
         try:
-            job_res = supabase.table("mastering_jobs").select(
+            job_res = await run_in_threadpool(supabase.table("mastering_jobs").select(
                 "user_email, file_name"
-            ).eq("id", request.jobId).execute()
+            ).eq("id", request.jobId).execute)
             if job_res.data:
                 job_info = job_res.data[0]
                 notify_url = f"{supabase_url}/functions/v1/notify-on-complete"
-                requests.post(notify_url, json={
+                await run_in_threadpool(requests.post, notify_url, json={
                     "id": request.jobId,
                     "status": "completed",
                     "user_email": job_info.get("user_email"),
@@ -311,6 +318,7 @@ async def master_from_url(request: MasterFromUrlRequest):
             "achievedLUFS": round(final_lufs, 2),
             "iterations": iterations,
             "appliedParams": dsp.params_to_dict(params),
+            "stageCache": cache_stats,
         }
 
     except Exception as e:
@@ -319,10 +327,10 @@ async def master_from_url(request: MasterFromUrlRequest):
         traceback.print_exc()
         if supabase:
             try:
-                supabase.table("mastering_jobs").update({
+                await run_in_threadpool(supabase.table("mastering_jobs").update({
                     "status": "failed",
                     "error_message": f"DSP Engine: {error_msg}",
-                }).eq("id", request.jobId).execute()
+                }).eq("id", request.jobId).execute)
             except Exception:
                 pass
         for f_path in [f"/tmp/input_{request.jobId}.wav", f"/tmp/output_{request.jobId}.wav"]:
@@ -333,6 +341,70 @@ async def master_from_url(request: MasterFromUrlRequest):
         raise HTTPException(status_code=500, detail=error_msg)
 
 
+class AnalysisProxyRequest(BaseModel):
+    jobId: Optional[str] = None
+    bucket: str
+    path: str
+    midSide: bool = False
+
+
+@app.post("/proxy")
+async def make_analysis_proxy(request: AnalysisProxyRequest):
+    """
+    Called by the analysis trigger right after upload.
+    Writes a small mono (or M/S) 16 kHz excerpt next to the original so the
+    persona prompts don't have to read the full-resolution WAV.
+    """
+    # GCS イベントは重複配信されうるので、同じジョブの同時実行でも衝突しない一時ファイル名にする
+    in_fd, local_input = tempfile.mkstemp(prefix="proxy_src_", suffix=".wav")
+    out_fd, local_output = tempfile.mkstemp(prefix="proxy_", suffix=".wav")
+    os.close(in_fd)
+    os.close(out_fd)
+    try:
+        bucket = storage_client.bucket(request.bucket)
+        await run_in_threadpool(bucket.blob(request.path).download_to_filename, local_input)
+
+        # マスタリング用プールの後ろに並ばないよう、ベクトル化済みのプロキシ生成はスレッドで実行する
+        info = await run_in_threadpool(
+            analysis_proxy.make_analysis_proxy,
+            local_input,
+            local_output,
+            analysis_proxy.PROXY_SAMPLE_RATE,
+            request.midSide,
+        )
+
+        proxy_path = analysis_proxy.proxy_path_for(request.path)
+        await run_in_threadpool(
+            bucket.blob(proxy_path).upload_from_filename, local_output, content_type="audio/wav"
+        )
+        proxy_uri = f"gs://{request.bucket}/{proxy_path}"
+
+        ratio = os.path.getsize(local_input) / max(1, os.path.getsize(local_output))
+        print(f"[/proxy] {request.path} -> {proxy_path} ({ratio:.1f}x smaller, {info['proxySeconds']}s)")
+
+        # プロキシはアップロード済みで、トリガーはレスポンスの proxyUri を使うので DB 更新の失敗は致命的にしない
+        if request.jobId and supabase:
+            try:
+                await run_in_threadpool(supabase.table("mastering_jobs").update({
+                    "analysis_proxy_path": proxy_path,
+                }).eq("id", request.jobId).execute)
+            except Exception as e:
+                print(f"[/proxy] Warning: Could not record analysis_proxy_path: {str(e)}")
+
+        return {"status": "success", "proxyUri": proxy_uri, "sizeRatio": round(ratio, 1), **info}
+
+    except Exception as e:
+        # 解析側は原音にフォールバックできるのでジョブは failed にしない
+        print(f"[/proxy] ERROR: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for f_path in [local_input, local_output]:
+            try:
+                os.remove(f_path)
+            except Exception:
+                pass
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
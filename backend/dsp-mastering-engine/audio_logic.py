@@ -9,6 +9,8 @@ import numpy as np
 from dataclasses import dataclass, field
 from typing import Optional, Tuple
 
+from stage_cache import StageCacheSession, buffer_key, chain_key
+
 # ─── パラメータ型（AI / エンジンから渡す。固定レシピで上書きしない）────────────────
 
 @dataclass
@@ -226,43 +228,105 @@ def apply_neuro_drive(buffer: np.ndarray, sample_rate: float) -> None:
 
 # ─── 本番チェーン（シミュレーションと同一にすること）────────────────────────────
 
-def process_mono_channel(
-    channel: np.ndarray,
-    sample_rate: float,
-    params: MasteringParams
-) -> None:
+def _stage_gain(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     gain_linear = 10 ** (params.gain_adjustment_db / 20)
     channel *= gain_linear
 
+
+def _stage_tube(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     tube_curve = make_tube_curve(params.tube_drive_amount)
     apply_wave_shaper(channel, tube_curve)
 
+
+def _stage_pultec(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     apply_pultec_style(channel, sample_rate, params.low_contour_amount)
 
+
+def _stage_clipper(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     clipper_curve = make_clipper_curve(0.99)
     apply_wave_shaper(channel, clipper_curve)
 
+
+def _stage_limiter(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     apply_limiter(channel, sample_rate, params.limiter_ceiling_db, 5.0)
 
+
+def _stage_neuro_drive(channel: np.ndarray, sample_rate: float, params: MasteringParams) -> None:
     apply_neuro_drive(channel, sample_rate)
 
 
+# (段名, その段の出力に効くパラメータ, 処理)。順序がそのまま本番チェーンの順序。
+# チェックポイントのキーはここに列挙したパラメータから作るので、段に新しいパラメータを足したら必ず追記すること。
+MONO_CHAIN_STAGES = (
+    ('gain', ('gain_adjustment_db',), _stage_gain),
+    ('tube', ('tube_drive_amount',), _stage_tube),
+    ('pultec', ('low_contour_amount',), _stage_pultec),
+    ('clipper', (), _stage_clipper),
+    ('limiter', ('limiter_ceiling_db',), _stage_limiter),
+    ('neuro_drive', (), _stage_neuro_drive),
+)
+
+# チェックポイントを置く深さ（完了した段数）。再開して意味があるのは「次の段がパラメータを持つ」直前だけ
+# （gain 以外の各パラメータ段の直前 = gain 後・tube 後・clipper 後）。それ以外は保存しても使われない。
+CHECKPOINT_DEPTHS = tuple(
+    depth for depth in range(1, len(MONO_CHAIN_STAGES)) if MONO_CHAIN_STAGES[depth][1]
+)
+
+
+def process_mono_channel(
+    channel: np.ndarray,
+    sample_rate: float,
+    params: MasteringParams,
+    cache: Optional[StageCacheSession] = None,
+) -> None:
+    """
+    cache を渡すと CHECKPOINT_DEPTHS の段出力をチェックポイントとして保存し、
+    入力と上流パラメータが同じなら最も深いチェックポイントから再開する。
+    """
+    if cache is None:
+        for _, _, stage in MONO_CHAIN_STAGES:
+            stage(channel, sample_rate, params)
+        return
+
+    keys = []
+    key = buffer_key(channel, sample_rate)
+    for name, fields, _ in MONO_CHAIN_STAGES:
+        key = chain_key(key, name, *(getattr(params, f) for f in fields))
+        keys.append(key)
+
+    start = 0
+    for depth in reversed(CHECKPOINT_DEPTHS):
+        checkpoint = cache.get(keys[depth - 1])
+        if checkpoint is not None:
+            channel[:] = checkpoint
+            start = depth
+            break
+    cache.record(start)
+
+    for depth in range(start, len(MONO_CHAIN_STAGES)):
+        MONO_CHAIN_STAGES[depth][2](channel, sample_rate, params)
+        if depth + 1 in CHECKPOINT_DEPTHS:
+            cache.put(keys[depth], channel)
+
+
 def build_mastering_chain(
     left: np.ndarray,
     right: np.ndarray,
     sample_rate: float,
-    params: MasteringParams
+    params: MasteringParams,
+    cache: Optional[StageCacheSession] = None,
 ) -> None:
     """
     本番と同一のマスタリングチェーンを適用する。
     M/S 時は Mid/Side 別に tube_drive をかけ、Mono 時はパラメータ駆動。
+    cache を渡すと Mid/Side それぞれ段ごとのチェックポイントから再開する。
     """
     length = len(left)
     mid = (left + right) * 0.5
     side = (left - right) * 0.5
 
-    process_mono_channel(mid, sample_rate, params)
-    process_mono_channel(side, sample_rate, params)
+    process_mono_channel(mid, sample_rate, params, cache)
+    process_mono_channel(side, sample_rate, params, cache)
 
     left[:] = mid + side
     right[:] = mid - side
@@ -308,6 +372,8 @@ def optimize_mastering_params(
     """
     自己補正ループ（0.1 dB 単位で gain_adjustment_db を補正）
     最適化: 全体ではなく、中央10秒間のサンプルを使用して演算負荷とメモリ消費を大幅に削減。
+    目標付近で往復して同じパラメータを再評価する反復は、計測済みの LUFS を使い回す。
+    段チェックポイントは使わない（変えるのは先頭段の gain だけなので再開点がなく、本番レンダリングのキャッシュを押し出すだけ）。
     """
     max_iterations = 50
     step_db = 0.1
@@ -330,12 +396,19 @@ def optimize_mastering_params(
     left_work = np.zeros(sample_length, dtype=np.float32)
     right_work = np.zeros(sample_length, dtype=np.float32)
 
+    measured = {}
+
     for _ in range(max_iterations):
-        left_work[:] = left_sample
-        right_work[:] = right_sample
+        key = dataclasses.astuple(params)
+        if key in measured:
+            achieved_lufs = measured[key]
+        else:
+            left_work[:] = left_sample
+            right_work[:] = right_sample
 
-        build_mastering_chain(left_work, right_work, sample_rate, params)
-        achieved_lufs = measure_lufs(left_work, right_work, sample_rate)
+            build_mastering_chain(left_work, right_work, sample_rate, params)
+            achieved_lufs = measure_lufs(left_work, right_work, sample_rate)
+            measured[key] = achieved_lufs
 
         iterations += 1
         err = target_lufs - achieved_lufs
@@ -0,0 +1,297 @@
+"""
+DSP Worker Pool — 共有メモリ経由の PCM 受け渡し
+DSP は CPU バウンドなので API プロセス（uvicorn）から切り離し、事前起動したワーカープロセスで実行する。
+float32 の left/right をプロセス間で pickle しないこと。キューに流すのは共有メモリ名とパラメータだけ。
+"""
+
+import asyncio
+import dataclasses
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Optional, Tuple, TypeVar
+
+import numpy as np
+
+import audio_logic as dsp
+from stage_cache import StageCache
+
+T = TypeVar("T")
+
+
+# ─── 共有 PCM バッファ（(2, frames) float32、行 0 = left / 行 1 = right）────────────
+# API プロセスが確保・解放し、ワーカーは名前でアタッチしてゼロコピーのビューで in-place 処理する。
+# /dev/shm に収まらない場合（Docker 既定は 64 MB）は DSP_SCRATCH_DIR 上の memmap ファイルを使う。
+# tmpfs が溢れると書き込み時に SIGBUS でプロセスごと落ちるので、必ず確保前に空きを確認すること。
+
+SHM_DIR = "/dev/shm"
+SCRATCH_DIR = os.environ.get("DSP_SCRATCH_DIR", tempfile.gettempdir())
+
+
+def _shm_has_room(nbytes: int) -> bool:
+    try:
+        st = os.statvfs(SHM_DIR)
+    except OSError:
+        return False
+    # 同時に確保される他ジョブのぶんを見込んで余裕を持たせる
+    return st.f_bavail * st.f_frsize >= nbytes * 2
+
+
+class SharedPCM:
+    def __init__(self, frames: int, name: Optional[str] = None):
+        self.frames = frames
+        nbytes = max(1, 2 * frames * np.dtype(np.float32).itemsize)
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._path: Optional[str] = None
+        self._owner = name is None
+
+        if name is None:
+            if _shm_has_room(nbytes):
+                self._shm = self._create_shm(nbytes)
+            if self._shm is None:
+                fd, self._path = tempfile.mkstemp(dir=SCRATCH_DIR, prefix="pcm_", suffix=".f32")
+                with os.fdopen(fd, "wb") as f:
+                    f.truncate(nbytes)
+        elif os.path.isabs(name):
+            self._path = name
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        if self._shm is not None:
+            self.buffer = np.ndarray((2, frames), dtype=np.float32, buffer=self._shm.buf)
+        else:
+            self.buffer = np.memmap(self._path, dtype=np.float32, mode="r+", shape=(2, frames))
+
+    @staticmethod
+    def _create_shm(nbytes: int) -> Optional[shared_memory.SharedMemory]:
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        try:
+            # ftruncate だけでは実ページが確保されないので、ここで確保して ENOSPC を先に検出する
+            os.posix_fallocate(shm._fd, 0, nbytes)
+        except (OSError, AttributeError):
+            shm.close()
+            shm.unlink()
+            return None
+        return shm
+
+    @property
+    def name(self) -> str:
+        """ワーカーに渡す識別子。共有メモリ名、または memmap ファイルの絶対パス。"""
+        return self._shm.name if self._shm is not None else self._path
+
+    @property
+    def left(self) -> np.ndarray:
+        return self.buffer[0]
+
+    @property
+    def right(self) -> np.ndarray:
+        return self.buffer[1]
+
+    def close(self) -> None:
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
+        # ビューが残っていると SharedMemory.close() が BufferError になるため先に外す
+        self.buffer = None
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+        elif self._owner:
+            os.remove(self._path)
+
+    def __enter__(self) -> "SharedPCM":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def load_pcm(data: np.ndarray) -> SharedPCM:
+    """
+    wavfile.read の結果を共有メモリへ直接デコードする（float32 [-1, 1]、モノラルは両ch複製）。
+    中間の float32 配列を作らないので、大きなファイルでもコピーは 1 回で済む。
+    """
+    frames = data.shape[0]
+    pcm = SharedPCM(frames)
+    if data.ndim == 1:
+        pcm.left[:] = data
+        pcm.right[:] = data
+    else:
+        pcm.left[:] = data[:, 0]
+        pcm.right[:] = data[:, 1]
+
+    if data.dtype == np.int16:
+        pcm.buffer *= 1.0 / 32768.0
+    elif data.dtype == np.int32:
+        pcm.buffer *= 1.0 / 2147483648.0
+    return pcm
+
+
+# ─── ワーカー側ジョブ（子プロセスで実行。引数・戻り値は小さな dict / float のみ）────────
+
+# ワーカープロセスごとの段チェックポイント。既定では無効。再レンダリングは別ワーカーに当たりうるので、
+# 有効にするなら全ワーカー共有のディスク段（DSP_STAGE_CACHE_DIR）を使う（StageCache.from_env 参照）。
+_stage_cache: Optional[StageCache] = None
+
+
+def _init_stage_cache(workers: int) -> None:
+    global _stage_cache
+    _stage_cache = StageCache.from_env(workers)
+
+
+def _warm_up(_: int) -> int:
+    return os.getpid()
+
+
+def run_master_job(
+    shm_name: str,
+    frames: int,
+    sample_rate: int,
+    params: dict,
+    target_lufs: Optional[float],
+    measure_output: bool,
+) -> Tuple[dict, Optional[float], int, Optional[float], dict]:
+    """
+    共有メモリ上の PCM に自己補正ループ + 本番チェーンを in-place で適用する。
+    戻り値: (適用パラメータ, 補正ループの到達 LUFS, 反復回数, 出力の LUFS, このジョブの段キャッシュ統計)
+    """
+    # スレッドモードでは複数ジョブが同じキャッシュを共有するので、統計はジョブ単位のセッションで数える
+    cache = _stage_cache.session() if _stage_cache else None
+    pcm = SharedPCM(frames, name=shm_name)
+    try:
+        left, right = pcm.left, pcm.right
+        mastering_params = dsp.MasteringParams(**params)
+        achieved_lufs = None
+        iterations = 0
+
+        if target_lufs is not None:
+            mastering_params, achieved_lufs, iterations = dsp.optimize_mastering_params(
+                left, right, sample_rate, target_lufs, mastering_params
+            )
+
+        dsp.build_mastering_chain(left, right, sample_rate, mastering_params, cache)
+
+        output_lufs = dsp.measure_lufs(left, right, sample_rate) if measure_output else None
+        del left, right
+    finally:
+        pcm.close()
+
+    cache_stats = {}
+    if cache:
+        cache_stats = cache.stats()
+        print(f"[dsp-cache] pid={os.getpid()} {cache_stats}")
+    return dsp.params_to_dict(mastering_params), achieved_lufs, iterations, output_lufs, cache_stats
+
+
+# ─── API プロセス側のプール ──────────────────────────────────────────────────
+
+def available_cpus() -> int:
+    """
+    このプロセスが実際に使える CPU 数。os.cpu_count() はコンテナ内でもホストの数を返すので使わない。
+    CPU アフィニティに加え、cgroup v2 の CPU クォータ（cpu.max）があればそれで頭打ちにする。
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+class DSPWorkerPool:
+    """
+    起動時に全ワーカーを事前起動しておき、ジョブは共有メモリ名だけをキューで渡す。
+    workers=0 のときはプロセスを作らず API プロセス内のスレッドで実行する（ローカル検証用）。
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        if workers is None:
+            workers = int(os.environ.get("DSP_WORKERS", available_cpus()))
+        self.workers = max(0, workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._restart_lock = threading.Lock()
+
+    def start(self) -> None:
+        if self.workers == 0:
+            if _stage_cache is None:
+                _init_stage_cache(1)
+            return
+        if self._executor is not None:
+            return
+        # ワーカーが親と同じ resource_tracker を共有するよう起動前に立ち上げておく
+        # （ワーカー独自の tracker だと終了時に使用中の共有メモリを unlink してしまう）
+        resource_tracker.ensure_running()
+        # 再起動は I/O 中のスレッドがいる状態で走るので fork は使わない（継承したロックでワーカーが固まる）。
+        # forkserver は単一スレッドのサーバープロセスから fork し、tracker の fd も引き継ぐ。
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_stage_cache,
+            initargs=(self.workers,),
+        )
+        # ProcessPoolExecutor は遅延起動なので、最初のジョブ前に全ワーカーを立ち上げておく
+        list(self._executor.map(_warm_up, range(self.workers)))
+        print(f"[dsp-pool] {self.workers} worker process(es) ready")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        # 同時に失敗した複数ジョブから呼ばれても作り直しは 1 回だけ
+        with self._restart_lock:
+            if self._executor is not broken:
+                return
+            print("[dsp-pool] worker process died; restarting pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.start()
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        fn をワーカーで実行する。引数・戻り値は pickle されるので小さな値だけを渡すこと。
+        ワーカーが落ちて（OOM kill 等）プールが壊れた場合はプールを作り直し、このジョブだけ失敗させる。
+        in-place 処理の途中で落ちた可能性があるので再実行はしない。
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            if executor is not None:
+                await asyncio.to_thread(self._restart, executor)
+            raise
+
+    async def master(
+        self,
+        pcm: SharedPCM,
+        sample_rate: int,
+        params: dsp.MasteringParams,
+        target_lufs: Optional[float] = None,
+        measure_output: bool = False,
+    ) -> Tuple[dsp.MasteringParams, Optional[float], int, Optional[float], dict]:
+        """
+        pcm をワーカーで in-place マスタリングする。処理後の音声は pcm.left / pcm.right に戻る。
+        待機中もイベントループはブロックしない。最後の要素はこのジョブの段キャッシュ統計。
+        """
+        applied, achieved_lufs, iterations, output_lufs, cache_stats = await self.run(
+            run_master_job,
+            pcm.name,
+            pcm.frames,
+            int(sample_rate),
+            dsp.params_to_dict(params),
+            target_lufs,
+            measure_output,
+        )
+        return dataclasses.replace(params, **applied), achieved_lufs, iterations, output_lufs, cache_stats
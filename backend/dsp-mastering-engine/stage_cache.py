@@ -0,0 +1,235 @@
+"""
+Stage Cache — チェーン途中バッファのチェックポイント（メモリ / ディスク 2 段 LRU）
+キーは「入力バッファ + そこまでの段に効くパラメータ」から作るので、下流パラメータだけ変えた再レンダリングは
+最も深い有効チェックポイントから再開できる。チェーン自体の数値は変えないこと（キャッシュは結果を変えない）。
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+def buffer_key(buffer: np.ndarray, *extra) -> str:
+    """入力バッファの内容（dtype・長さ込み）と追加要素からキーを作る。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{buffer.dtype.str}:{buffer.shape}".encode())
+    h.update(memoryview(np.ascontiguousarray(buffer)).cast("B"))
+    for x in extra:
+        h.update(repr(x).encode())
+    return h.hexdigest()
+
+
+def chain_key(parent: str, stage: str, *values) -> str:
+    """親キーに段名とその段のパラメータを足した子キー。"""
+    return hashlib.blake2b(repr((parent, stage) + values).encode(), digest_size=16).hexdigest()
+
+
+class StageCache:
+    """
+    memory_bytes : メモリ段の上限（LRU で追い出し、追い出した分はディスク段へ落とす）。0 ならディスク段のみ。
+    disk_dir     : ディスク段のディレクトリ。None ならメモリのみ。複数ワーカーで共有してよい。
+    disk_bytes   : ディスク段の上限（mtime の古い順に削除。ヒット時に mtime を更新）
+    スレッドセーフ。ジョブ単位の統計は session() 経由で取ること。
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = 0,
+        disk_dir: Optional[str] = None,
+        disk_bytes: int = 4 * 1024 * 1024 * 1024,
+    ):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.stages_skipped = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, workers: int = 1) -> Optional["StageCache"]:
+        """
+        既定では無効（オプトイン）。1 ジョブで Mid/Side × 3 深さ = 6 本のフル長 float32 を保存するので
+        （44.1 kHz 6 分で約 380 MB）、Cloud Run のようにメモリ上の /tmp に黙って置いてはいけない。
+        DSP_STAGE_CACHE_MB      : メモリ段の合計（既定 0）。ワーカー数で等分する。
+        DSP_STAGE_CACHE_DIR     : ディスク段のディレクトリ。設定したときだけディスク段を使う。
+                                  再レンダリングは別ワーカーに当たりうるので、共有するならこちら。
+        DSP_STAGE_CACHE_DISK_MB : ディスク段の上限（DSP_STAGE_CACHE_DIR 設定時の既定 1024）
+        どちらも無効ならキャッシュ無効（None）。
+        """
+        memory_bytes = int(os.environ.get("DSP_STAGE_CACHE_MB", 0)) * 1024 * 1024 // max(1, workers)
+        disk_dir = os.environ.get("DSP_STAGE_CACHE_DIR") or None
+        disk_bytes = int(os.environ.get("DSP_STAGE_CACHE_DISK_MB", 1024 if disk_dir else 0)) * 1024 * 1024
+        if disk_bytes <= 0:
+            disk_dir = None
+        if memory_bytes <= 0 and disk_dir is None:
+            return None
+        return cls(memory_bytes=max(0, memory_bytes), disk_dir=disk_dir, disk_bytes=disk_bytes)
+
+    def session(self) -> "StageCacheSession":
+        return StageCacheSession(self)
+
+    # ─── 参照・格納 ─────────────────────────────────────────────────────────
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            buf = self._memory.get(key)
+            if buf is not None:
+                self._memory.move_to_end(key)
+                return buf
+        path = self._disk_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            buf = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if buf.nbytes <= self.memory_bytes:
+            self._put_memory(key, buf)
+        return buf
+
+    def put(self, key: str, buffer: np.ndarray) -> int:
+        """格納する。戻り値はこの格納で追い出したエントリ数。"""
+        if buffer.nbytes > self.memory_bytes:
+            return self._write_disk(key, buffer)
+        return self._put_memory(key, buffer.copy())
+
+    def _put_memory(self, key: str, buf: np.ndarray) -> int:
+        if buf.nbytes > self.memory_bytes:
+            return self._write_disk(key, buf)
+        demoted = []
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_used -= old.nbytes
+            self._memory[key] = buf
+            self._memory_used += buf.nbytes
+            while self._memory_used > self.memory_bytes:
+                old_key, old_buf = self._memory.popitem(last=False)
+                self._memory_used -= old_buf.nbytes
+                demoted.append((old_key, old_buf))
+            self.evictions += len(demoted)
+        # ディスク書き込みはロックの外で行う
+        return len(demoted) + sum(self._write_disk(k, b) for k, b in demoted)
+
+    # ─── ディスク段 ─────────────────────────────────────────────────────────
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        return os.path.join(self.disk_dir, f"{key}.npy") if self.disk_dir else None
+
+    def _write_disk(self, key: str, buf: np.ndarray) -> int:
+        path = self._disk_path(key)
+        if path is None or buf.nbytes > self.disk_bytes:
+            return 0
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return 0
+        # 他ワーカーが読みかけのファイルを見ないよう一時ファイルに書いてから置き換える
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, buf)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return 0
+        return self._evict_disk()
+
+    def _evict_disk(self) -> int:
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        used = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, name in sorted(entries):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+            used -= size
+            evicted += 1
+        with self._lock:
+            self.evictions += evicted
+        return evicted
+
+    # ─── 統計 ──────────────────────────────────────────────────────────────
+
+    def record(self, resumed_stages: int) -> None:
+        with self._lock:
+            if resumed_stages > 0:
+                self.hits += 1
+                self.stages_skipped += resumed_stages
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stagesSkipped": self.stages_skipped,
+                "evictions": self.evictions,
+                "memoryBytes": self._memory_used,
+                "memoryEntries": len(self._memory),
+            }
+
+
+class StageCacheSession:
+    """
+    1 ジョブぶんの窓口。格納・参照は共有の StageCache に委ね、統計だけをジョブ単位で数える。
+    同じキャッシュを使う他ジョブが並行していても、このジョブの数字は混ざらない。
+    """
+
+    def __init__(self, cache: StageCache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.stages_skipped = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self.cache.get(key)
+
+    def put(self, key: str, buffer: np.ndarray) -> None:
+        self.evictions += self.cache.put(key, buffer)
+
+    def record(self, resumed_stages: int) -> None:
+        self.cache.record(resumed_stages)
+        if resumed_stages > 0:
+            self.hits += 1
+            self.stages_skipped += resumed_stages
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stagesSkipped": self.stages_skipped,
+            "evictions": self.evictions,
+        }